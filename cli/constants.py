@@ -13,19 +13,15 @@ WANT = {
 # Subdirectory of hermetic.xj_llvm_root()
 SYSROOT_NAME = "sysroot"
 
+# The WANT entries (minus the 10j- prefix) that determine CI's OCaml cache key.
+OCAML_CACHE_KEY_PARTS = ("ocaml", "opam", "dune")
+
 if __name__ == "__main__":
     # This is a separate script from provisioning.py so that it can be run
     # with a stock Python interpreter, without any third-party modules.
     import sys
     import platform
 
-    match sys.argv:
-        case [_, "ocaml-cache-key"]:
-
-            def piece(k):
-                return f"{k}-{WANT['10j-' + k]}"
-
-            ocamlparts = ";".join(piece(k) for k in "ocaml opam dune".split())
-            print(";".join([platform.system(), platform.machine(), ocamlparts]))
-        case _:
-            pass
+    if sys.argv[1:] == ["ocaml-cache-key"]:
+        ocamlparts = ";".join(f"{k}-{WANT['10j-' + k]}" for k in OCAML_CACHE_KEY_PARTS)
+        print(";".join([platform.system(), platform.machine(), ocamlparts]))
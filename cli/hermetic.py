@@ -1,7 +1,8 @@
+import functools
 import subprocess
-import shlex
+import re
 import shutil
-import time
+import threading
 from pathlib import Path
 import os
 from typing import Sequence
@@ -11,10 +12,20 @@ import click
 import repo_root
 
 
-def check_call_uv(args: list[str]):
+# Set XJ_SHOW_CMDS=1 to echo each command before running it. Checked once, at import.
+SHOW_CMDS = os.environ.get("XJ_SHOW_CMDS", "0") != "0"
+
+
+@functools.cache
+def uv_cmd_prefix() -> tuple[str, ...]:
     # The args here should be kept in sync with the 10j script.
     localdir = repo_root.localdir()
-    subprocess.check_call([localdir / "uv", "--config-file", localdir / "uv.toml", *args])
+    return (str(localdir / "uv"), "--config-file", str(localdir / "uv.toml"))
+
+
+def check_call_uv(args: Sequence[str | os.PathLike[str]]):
+    # See run_output_git() for why close_fds=False.
+    subprocess.check_call([*uv_cmd_prefix(), *args], close_fds=False)
 
 
 def xj_build_deps(localdir: Path) -> Path:
@@ -26,33 +37,61 @@ def xj_llvm_root(localdir: Path) -> Path:
 
 
 def mk_env_for(localdir: Path, with_tenjin_deps=True, env_ext=None, **kwargs) -> dict[str, str]:
+    """
+    Note: the returned dict may be shared between calls, so callers must not modify it.
+    """
     if "env" in kwargs:
         env = kwargs["env"]
         del kwargs["env"]  # we'll pass it explicitly, so not via kwargs
+    elif env_ext is None:
+        # The common case: no customizations, so no need to copy os.environ each time.
+        return base_env_for(localdir, with_tenjin_deps)
     else:
-        env = os.environ.copy()
+        env = os.environ
 
     if env_ext is not None:
         env = {**env, **env_ext}
 
     if with_tenjin_deps:
+        llvm_lib_dir, path_prefix = tenjin_deps_env_parts(localdir)
         # We define LLVM_LIB_DIR for c2rust (unconditionally).
-        env["LLVM_LIB_DIR"] = str(xj_llvm_root(localdir) / "lib")
-        env["PATH"] = os.pathsep.join([
-            str(xj_build_deps(localdir) / "bin"),
-            str(xj_llvm_root(localdir) / "bin"),
-            str(localdir / "cmake" / "bin"),
-            env["PATH"],
-        ])
+        env["LLVM_LIB_DIR"] = llvm_lib_dir
+        env["PATH"] = path_prefix + env["PATH"]
 
     return env
 
 
+@functools.cache
+def base_env_for(localdir: Path, with_tenjin_deps: bool) -> dict[str, str]:
+    """mk_env_for() without env_ext, built once per process.
+
+    Nothing in 10j modifies os.environ, so this doesn't go stale;
+    per-call changes should be passed as env_ext instead.
+    """
+    return mk_env_for(localdir, with_tenjin_deps, env_ext={})
+
+
+@functools.cache
+def tenjin_deps_env_parts(localdir: Path) -> tuple[str, str]:
+    """Returns LLVM_LIB_DIR and the prefix to prepend to PATH, for the given localdir.
+
+    These are fixed for the life of the process, and mk_env_for() is called
+    for every subprocess we spawn, so they are only computed once.
+    """
+    path_prefix = os.pathsep.join([
+        str(xj_build_deps(localdir) / "bin"),
+        str(xj_llvm_root(localdir) / "bin"),
+        str(localdir / "cmake" / "bin"),
+        "",
+    ])
+    return str(xj_llvm_root(localdir) / "lib"), path_prefix
+
+
 def run_command_with_progress(command, stdout_file, stderr_file, shell=False) -> None:
     """
     Run a command, redirecting stdout/stderr to files, and print dots while waiting.
     """
-    if os.environ.get("XJ_SHOW_CMDS", "0") != "0":
+    if SHOW_CMDS:
         click.echo(f": {command}")
 
     with open(stdout_file, "wb") as out_f, open(stderr_file, "wb") as err_f:
@@ -60,15 +99,25 @@ def run_command_with_progress(command, stdout_file, stderr_file, shell=False) ->
             command,
             stdout=out_f,
             stderr=err_f,
-            bufsize=1,
             shell=shell,
             env=mk_env_for(repo_root.localdir(), with_tenjin_deps=True, env_ext=None),
         )
 
-        while proc.poll() is None:
-            # Process is still running
-            print(".", end="", flush=True)
-            time.sleep(0.3)
+        # Print dots from a helper thread so that we notice the moment the
+        # process exits, rather than on the next tick of a polling loop.
+        done = threading.Event()
+
+        def print_dots():
+            while not done.wait(0.3):
+                print(".", end="", flush=True)
+
+        dotter = threading.Thread(target=print_dots, daemon=True)
+        dotter.start()
+        try:
+            proc.wait()
+        finally:
+            done.set()
+            dotter.join()
 
         # Final newline after progress dots
         print()
@@ -81,7 +130,7 @@ type RunSpec = str | Sequence[str | bytes | os.PathLike[str] | os.PathLike[bytes
 def run(
     cmd: RunSpec, check=False, with_tenjin_deps=True, env_ext=None, **kwargs
 ) -> subprocess.CompletedProcess:
-    if os.environ.get("XJ_SHOW_CMDS", "0") != "0":
+    if SHOW_CMDS:
         click.echo(f": {cmd}")
 
     return subprocess.run(
@@ -92,17 +141,6 @@ def run(
     )
 
 
-def run_shell_cmd(
-    cmd: RunSpec, check=False, with_tenjin_deps=True, env_ext=None, **kwargs
-) -> subprocess.CompletedProcess:
-    if not isinstance(cmd, str):
-        cmd = " ".join(shlex.quote(str(x)) for x in cmd)
-
-    return run(
-        cmd, check=check, with_tenjin_deps=with_tenjin_deps, env_ext=env_ext, shell=True, **kwargs
-    )
-
-
 def cargo_toolchain_specifier() -> str:
     return "+stable"
 
@@ -164,11 +202,21 @@ def opam_non_hermetic() -> bool:
     return running_in_ci() and shutil.which("opam") is not None
 
 
+@functools.cache
+def opam_invariant_strs(localdir: Path) -> tuple[str, str, str]:
+    """The opam binary, opam root, and goblint wrapper dir that run_opam uses, as strings."""
+    return (
+        str(localdir / "opam"),
+        str(opamroot(localdir)),
+        str(xj_llvm_root(localdir) / "goblint-sadness"),
+    )
+
+
 def run_opam(
     args: list[str], eval_opam_env=True, with_tenjin_deps=True, check=False, env_ext=None, **kwargs
 ) -> subprocess.CompletedProcess:
     localdir = repo_root.localdir()
-    localopam = localdir / "opam"
+    localopam, localopamroot, goblint_sadness = opam_invariant_strs(localdir)
 
     def insert_opam_subcmd_args(args: list[str], subcmd_args: list[str]) -> list[str]:
         match args:
@@ -182,29 +230,15 @@ def run_opam(
             case _:
                 raise ValueError("Invalid args for opam command")
 
-    def mk_shell_cmd() -> str:
-        def shell_cmd(parts: list[str]) -> str:
-            return " ".join(str(x) for x in parts)
-
-        hermetic = not opam_non_hermetic()
-
-        opam_subcmd_args = ["--cli=2.3"]
-        if hermetic:
-            opam_subcmd_args += ["--root", str(opamroot(localdir))]
-        else:
-            # We save about four minutes per run in CI by using the system opam.
-            # If it appears to be installed, use it.
-            pass
-
-        maincmd = shell_cmd([str(localopam), *insert_opam_subcmd_args(args, opam_subcmd_args)])
+    hermetic = not opam_non_hermetic()
 
-        if eval_opam_env:
-            opam_env_cmd = f"{localopam} env {shell_cmd(opam_subcmd_args)}"
-            opam_env_cmd += " --switch=tenjin --set-switch --set-root"
-
-            return f"eval $({opam_env_cmd}) && {maincmd}"
-        else:
-            return maincmd
+    opam_subcmd_args = ["--cli=2.3"]
+    if hermetic:
+        opam_subcmd_args += ["--root", localopamroot]
+    else:
+        # We save about four minutes per run in CI by using the system opam.
+        # If it appears to be installed, use it.
+        pass
 
     # Opam's warnings about running as root aren't particularly actionable.
     if not env_ext:
@@ -213,7 +247,7 @@ def run_opam(
         env_ext["OPAMROOTISOK"] = "1"
 
     # See COMMENTARY(goblint-cil-gcc-wrapper)
-    path_elts = [str(xj_llvm_root(localdir) / "goblint-sadness")]
+    path_elts = [goblint_sadness]
     # If PATH is in env_ext, it is assumed to be a full PATH, not a delta.
     if "PATH" in env_ext:
         path_elts.append(env_ext["PATH"])
@@ -221,7 +255,87 @@ def run_opam(
         path_elts.append(os.environ["PATH"])
     env_ext["PATH"] = os.pathsep.join(path_elts)
 
-    return run_shell_cmd(mk_shell_cmd(), check, with_tenjin_deps, env_ext, **kwargs)
+    # Rather than running `eval $(opam env) && opam ...` via a shell, we ask
+    # opam for the environment it wants and apply it ourselves. The full env
+    # is passed as env_ext, so mk_env_for() must not prepend our deps again.
+    env = mk_env_for(localdir, with_tenjin_deps, env_ext)
+    if eval_opam_env:
+        env = {**env, **opam_env_vars(localopam, opam_subcmd_args, env)}
+
+    cmd = [localopam, *insert_opam_subcmd_args(args, opam_subcmd_args)]
+    return run(cmd, check, with_tenjin_deps=False, env_ext=env, **kwargs)
+
+
+# opam prints each variable as an OCaml-escaped ("NAME" "value") pair.
+OPAM_ENV_SEXP_PAIR_RE = re.compile(r'\(\s*"((?:[^"\\]|\\.)*)"\s+"((?:[^"\\]|\\.)*)"\s*\)')
+OPAM_ENV_SEXP_ESCAPE_RE = re.compile(r"\\(\d{3}|.)")
+
+
+def parse_opam_env_sexp(sexp: str) -> dict[str, str]:
+    """
+    >>> parse_opam_env_sexp('(("OPAMSWITCH" "tenjin") ("OPAMROOT" "/x/opamroot"))')
+    {'OPAMSWITCH': 'tenjin', 'OPAMROOT': '/x/opamroot'}
+
+    Non-ASCII bytes come out of opam escaped one byte at a time, as in OCaml's %S:
+    >>> parse_opam_env_sexp('(("OPAMROOT" "/home/j\\\\195\\\\169r\\\\195\\\\180me/opamroot"))')
+    {'OPAMROOT': '/home/jérôme/opamroot'}
+    """
+
+    def unescape(s: str) -> str:
+        # Each \ddd escape is a single byte of a (usually UTF-8) path, so put the
+        # bytes back together before decoding, rather than decoding them one by one.
+        out = bytearray()
+        pos = 0
+        for m in OPAM_ENV_SEXP_ESCAPE_RE.finditer(s):
+            out += s[pos : m.start()].encode("utf-8", "surrogateescape")
+            c = m.group(1)
+            if len(c) == 3:
+                out.append(int(c))
+            else:
+                out += {"n": "\n", "t": "\t", "r": "\r", "b": "\b"}.get(c, c).encode("utf-8")
+            pos = m.end()
+        out += s[pos:].encode("utf-8", "surrogateescape")
+        return out.decode("utf-8", "surrogateescape")
+
+    return {unescape(k): unescape(v) for k, v in OPAM_ENV_SEXP_PAIR_RE.findall(sexp)}
+
+
+OPAM_ENV_CACHE: dict[tuple[str, ...], dict[str, str]] = {}
+
+
+def opam_env_vars(
+    localopam: str, opam_subcmd_args: list[str], env: dict[str, str]
+) -> dict[str, str]:
+    """The variables that `eval $(opam env ...)` would set for the tenjin switch.
+
+    The answer only depends on which opam/root we ask and the PATH we start from,
+    so it is cached for the rest of the process after the first successful call.
+    """
+    key = (localopam, *opam_subcmd_args, env.get("PATH", ""))
+    if key in OPAM_ENV_CACHE:
+        return OPAM_ENV_CACHE[key]
+
+    cp = subprocess.run(
+        [
+            localopam,
+            "env",
+            *opam_subcmd_args,
+            "--switch=tenjin",
+            "--set-switch",
+            "--set-root",
+            "--sexp",
+        ],
+        check=False,
+        env=env,
+        stdout=subprocess.PIPE,
+    )
+    # Before the switch exists, `opam env` fails; like the shell `eval` we
+    # used to do, carry on without it and let the real command complain.
+    # Failures aren't cached, so we pick the env up once the switch is created.
+    if cp.returncode != 0:
+        return {}
+    OPAM_ENV_CACHE[key] = parse_opam_env_sexp(cp.stdout.decode("utf-8"))
+    return OPAM_ENV_CACHE[key]
 
 
 def check_call_opam(
@@ -234,20 +348,38 @@ def check_call_opam(
     return cp
 
 
-def run_output_git(args: list[str], check=False) -> bytes:
+@functools.cache
+def git_cmd_prefix() -> tuple[str, ...]:
+    """The argv prefix for running git against this repo.
+
+    Computed once per process, since asking jj for its backing git directory
+    costs a subprocess and the answer won't change under our feet.
+    """
+    # Using git's full path lets subprocess launch it with posix_spawn; see run_output_git().
+    git = shutil.which("git") or "git"
     jjdir = repo_root.find_repo_root_dir_Path() / ".jj"
     if jjdir.is_dir():
-        gitroot = subprocess.check_output(["jj", "git", "root"]).decode("utf-8")
-        cp = subprocess.run(["git", "--git-root", gitroot, *args], check=False, capture_output=True)
-    else:
-        cp = subprocess.run(["git", *args], check=False, capture_output=True)
+        gitdir = subprocess.check_output(["jj", "git", "root"]).decode("utf-8").rstrip("\n")
+        return (git, "--git-dir", gitdir)
+    return (git,)
 
-    if cp.stderr:
-        click.echo(cp.stderr, err=True)
-    if check:
-        cp.check_returncode()
+
+def run_output_git(args: Sequence[str | bytes], check=False, input: bytes | None = None) -> bytes:
+    # git's stderr goes straight to ours rather than being buffered and echoed;
+    # with stdout as the only pipe, the output is read in a single pass.
+    #
+    # Python creates its file descriptors non-inheritable, so there is nothing for
+    # close_fds=True to close; leaving it off (with an absolute executable path)
+    # lets subprocess use posix_spawn rather than fork + exec.
+    cp = subprocess.run(
+        [*git_cmd_prefix(), *args],
+        check=check,
+        input=input,
+        stdout=subprocess.PIPE,
+        close_fds=False,
+    )
     return cp.stdout
 
 
-def check_output_git(args: list[str]):
+def check_output_git(args: Sequence[str | bytes]):
     return run_output_git(args, check=True)
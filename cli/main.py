@@ -3,12 +3,13 @@ import sys
 import os
 import re
 import platform
+import functools
+import shlex
+from typing import Callable
 
 import click
-from packaging.version import Version
 
 import repo_root
-import provisioning
 import hermetic
 
 
@@ -23,65 +24,112 @@ def check_lib_deps_gmp():
             consider("/usr/x86_64-linux-gnu/libgmp.so.10")
 
 
+def parse_git_version(output: str) -> str:
+    # 'git version 2.43.0'
+    # 'git version 2.37.1 (Apple Git-137.1)'
+    git_version_mid = output.removeprefix("git version ")
+    return git_version_mid.split(" ")[0].strip()
+
+
+def parse_clang_version(output: str) -> str:
+    # '''
+    # Ubuntu clang version 18.1.3 (1ubuntu1)
+    # Target: x86_64-pc-linux-gnu
+    # Thread model: posix
+    # InstalledDir: /usr/bin
+    # '''
+    #
+    # '''
+    # Apple clang version 14.0.0 (clang-1400.0.29.202)
+    # Target: arm64-apple-darwin22.6.0
+    # Thread model: posix
+    # InstalledDir: /Applications/Xcode.app/[...]/XcodeDefault.xctoolchain/usr/bin
+    # '''
+    clang_version_m = re.search(r"clang version ([^ ]+)", output)
+    assert clang_version_m is not None
+    return clang_version_m.group(1)
+
+
+def version_tuple(version: str) -> tuple[int, ...]:
+    """The leading dotted-numeric part of a version string, for simple comparisons.
+
+    >>> version_tuple("2.37.1.windows.1"), version_tuple("19.0.0git")
+    ((2, 37, 1), (19, 0, 0))
+    """
+    m = re.match(r"\d+(?:\.\d+)*", version)
+    return tuple(int(part) for part in m.group(0).split(".")) if m else ()
+
+
+# Maps tool name to the args that make it print its version, and a parser for that output.
+TOOL_VERSION_PROBES: dict[str, tuple[list[str], Callable[[str], str]]] = {
+    "git": (["version"], parse_git_version),
+    "clang": (["--version"], parse_clang_version),
+}
+
+
+@functools.cache
+def find_tool_version(tool: str) -> str:
+    """Returns the version of the given tool on PATH, running it only once per process."""
+    args, parse = TOOL_VERSION_PROBES[tool]
+    return parse(subprocess.check_output([tool, *args]).decode("utf-8"))
+
+
+# uv arguments for the tool info that `10j status` reports.
+UV_STATUS_REPORT_ARGS = (("run", "ruff", "version"), ("tool", "dir"), ("tool", "list"))
+
+
 def do_check_deps(report: bool):
-    def find_git_version() -> str:
-        # 'git version 2.43.0'
-        # 'git version 2.37.1 (Apple Git-137.1)'
-        git_version_full = subprocess.check_output(["git", "version"]).decode("utf-8")
-        git_version_mid = git_version_full.removeprefix("git version ")
-        return git_version_mid.split(" ")[0].strip()
-
-    def find_clang_version() -> str:
-        # '''
-        # Ubuntu clang version 18.1.3 (1ubuntu1)
-        # Target: x86_64-pc-linux-gnu
-        # Thread model: posix
-        # InstalledDir: /usr/bin
-        # '''
-        #
-        # '''
-        # Apple clang version 14.0.0 (clang-1400.0.29.202)
-        # Target: arm64-apple-darwin22.6.0
-        # Thread model: posix
-        # InstalledDir: /Applications/Xcode.app/[...]/XcodeDefault.xctoolchain/usr/bin
-        # '''
-        clang_version_full = subprocess.check_output(["clang", "--version"]).decode("utf-8")
-        clang_version_m = re.search(r"clang version ([^ ]+)", clang_version_full)
-        assert clang_version_m is not None
-        return clang_version_m.group(1)
-
-    def find_opam_version() -> str:
-        return subprocess.check_output(["opam", "--version"]).decode("utf-8").rstrip()
-
-    git_version = find_git_version()
-    clang_version = find_clang_version()
-
-    if Version(git_version) < Version("2.36"):
+    git_version = find_tool_version("git")
+    clang_version = find_tool_version("clang")
+
+    if version_tuple(git_version) < (2, 36):
         click.echo("Note: git version 2.36 or later is required")
 
-    if Version(clang_version) < Version("18"):
+    if version_tuple(clang_version) < (18,):
         click.echo("Note: clang version 18 or later is required")
 
     if report:
         click.echo(f"{git_version=}")
         click.echo(f"{clang_version=}")
-        hermetic.check_call_uv("run ruff version".split())
-        hermetic.check_call_uv("tool dir".split())
-        hermetic.check_call_uv("tool list".split())
+        # These are independent, so start them all before waiting on any,
+        # then print their output in order. Every process is waited on before
+        # we report a failure, so none are left running behind us.
+        cmds = [[*hermetic.uv_cmd_prefix(), *args] for args in UV_STATUS_REPORT_ARGS]
+        procs = [subprocess.Popen(cmd, stdout=subprocess.PIPE, close_fds=False) for cmd in cmds]
+        outs = [proc.communicate()[0] for proc in procs]
+        for cmd, proc, out in zip(cmds, procs, outs):
+            click.echo(out, nl=False)
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+# uv arguments for the Python formatting and linting checks.
+UV_RUFF_FORMAT_ARGS = ("run", "ruff", "format")
+UV_RUFF_CHECK_ARGS = ("run", "ruff", "check", "--quiet")
+# Only run after UV_RUFF_CHECK_ARGS, which has already synced the environment.
+UV_RUFF_FORMAT_CHECK_ARGS = ("run", "--no-sync", "ruff", "format", "--check")
 
 
 def do_fmt_py():
-    hermetic.check_call_uv("run ruff format".split())
+    hermetic.check_call_uv(UV_RUFF_FORMAT_ARGS)
 
 
 def do_check_py_fmt():
-    hermetic.check_call_uv("run ruff format --check".split())
+    hermetic.check_call_uv(UV_RUFF_FORMAT_CHECK_ARGS)
 
 
 def do_check_py():
     root = repo_root.find_repo_root_dir_Path()
-    hermetic.check_call_uv("run ruff check --quiet".split())
-    hermetic.check_call_uv(["run", "mypy", root / "cli" / "main.py", root / "cli" / "constants.py"])
+    hermetic.check_call_uv(UV_RUFF_CHECK_ARGS)
+    # The first `uv run` has already synced the project environment,
+    # so later ones needn't spend time re-checking it.
+    hermetic.check_call_uv([
+        "run",
+        "--no-sync",
+        "mypy",
+        root / "cli" / "main.py",
+        root / "cli" / "constants.py",
+    ])
     do_check_py_fmt()
 
 
@@ -114,14 +162,23 @@ def do_test_unit_rs():
     )
 
 
-def parse_git_name_status_line(bs: bytes) -> tuple[str, bytes]:
+def find_files_larger_than(rootdir: bytes, max_file_size: int, pruned: set[bytes]) -> list[bytes]:
     """
-    >>> parse_git_name_status_line(b'A       .gitignore')
-    ("A", b'.gitignore')
+    Like `find rootdir -type f -size +{max_file_size}c`, skipping the pruned directories,
+    but walked in-process, with one stat per file and no child process.
     """
-    status = bs[0:1].decode("utf-8")
-    path = bs.split(b"\t", 1)[-1]
-    return (status, path)
+    found = []
+    pending = [rootdir]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path not in pruned:
+                        pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    if entry.stat(follow_symlinks=False).st_size > max_file_size:
+                        found.append(entry.path)
+    return sorted(found)
 
 
 def do_check_repo_file_sizes() -> bool:
@@ -130,40 +187,31 @@ def do_check_repo_file_sizes() -> bool:
     max_file_size = 987654
 
     rootdir = repo_root.find_repo_root_dir_Path()
-    # fmt: off
-    exclusions = [
-        "-path", rootdir / ".git", "-o",
-        "-path", rootdir / ".jj", "-o",
-        "-path", rootdir / "cli" / ".venv", "-o",
-        "-path", rootdir / "_local",
-    ]
-    cmd = [
-        "find", str(rootdir), "(", *[str(x) for x in exclusions], ")", "-prune", "-o",
-            "-type", "f", "-size", f"+{max_file_size}c", "-print",
-    ]
-    # fmt: on
-    lines = subprocess.check_output(cmd, stderr=subprocess.PIPE).split(b"\n")
-    strlines = [os.fsdecode(line) for line in lines if line != b""]
-    if not strlines:
+    pruned = {
+        os.fsencode(rootdir / ".git"),
+        os.fsencode(rootdir / ".jj"),
+        os.fsencode(rootdir / "cli" / ".venv"),
+        os.fsencode(rootdir / "_local"),
+    }
+    # Paths stay as bytes all the way through git; we only decode the ones we report.
+    bytelines = find_files_larger_than(os.fsencode(rootdir), max_file_size, pruned)
+    if not bytelines:
         return True
 
     # See https://git-scm.org/docs/git-check-ignore for details of the output format.
+    # Paths go through stdin rather than argv, so there's no limit on how many we pass.
     # We don't check the return value because it is non-zero when no path is ignored,
     # which is not an error case in this context.
-    lines = hermetic.run_output_git([
-        "check-ignore",
-        "--verbose",
-        "--non-matching",
-        *strlines,
-    ]).split(b"\n")
+    out = hermetic.run_output_git(
+        ["check-ignore", "--verbose", "--non-matching", "--stdin", "-z"],
+        input=b"\0".join(bytelines) + b"\0",
+    )
+    # With -z, each record is four NUL-terminated fields: source, linenum, pattern, pathname.
+    fields = out.split(b"\0")
     non_ignored = []
-    for line in lines:
-        if line == b"":
-            continue
-
-        fields, pathname = line.split(b"\t")
-        if fields == b"::":
-            # Fields are source COLON linenum COLON pattern
+    for i in range(0, len(fields) - 3, 4):
+        source, linenum, pattern, pathname = fields[i : i + 4]
+        if source == linenum == pattern == b"":
             # If all fields are empty, the pathname did not match any pattern,
             # which is to say: it was not ignored.
             non_ignored.append(pathname)
@@ -171,9 +219,9 @@ def do_check_repo_file_sizes() -> bool:
     if not non_ignored:
         return True
 
-    click.echo("ERROR: Unexpected large files:", err=True)
-    for line in non_ignored:
-        click.echo("\t" + os.fsdecode(line), err=True)
+    # Only pay for formatting once we know there is something to report.
+    msg = "".join("\n\t" + os.fsdecode(line) for line in non_ignored)
+    click.echo("ERROR: Unexpected large files:" + msg, err=True)
     return False
 
 
@@ -235,10 +283,21 @@ def check_star():
     # another, and doing so is quite awkward.
     # We instead implement functionality in the do_*() functions
     # and then make each command be a thin wrapper to invoke the fn.
-    try:
-        do_check_py()
-        do_check_rs()
-    except subprocess.CalledProcessError:
+    #
+    # The Python and Rust checks are independent, so run them side by side;
+    # the total time is then that of the slower one (invariably clippy).
+    import concurrent.futures  # noqa: PLC0415
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(do_check_py), pool.submit(do_check_rs)]
+
+    failed = False
+    for future in futures:
+        try:
+            future.result()
+        except subprocess.CalledProcessError:
+            failed = True
+    if failed:
         sys.exit(1)
 
 
@@ -276,9 +335,18 @@ def exec():
 @cli.command()
 @click.argument("wanted", required=False, default="all")
 def provision(wanted: str):
+    # Imported here rather than at the top of the file because provisioning is
+    # comparatively slow to import (it loads packaging, tarfile, urllib and
+    # our HAVE file), and most 10j invocations never need it.
+    import provisioning  # noqa: PLC0415
+
     provisioning.provision_desires(wanted)
 
 
+# Matches a `NAME=value` word, which the shell treats as a variable assignment.
+SHELL_ASSIGNMENT_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*=")
+
+
 if __name__ == "__main__":
     # Per its own documentation, Click does not support losslessly forwarding
     # command line arguments. So when we want to do that, we bypass Click.
@@ -294,7 +362,17 @@ if __name__ == "__main__":
         if sys.argv[1] == "cargo":
             sys.exit(hermetic.run_cargo_in(sys.argv[2:], cwd=None, check=False).returncode)
         if sys.argv[1] == "exec":
-            sys.exit(hermetic.run_shell_cmd(sys.argv[2:]).returncode)
+            # Run the command directly when we can, saving a `sh -c` process. But a
+            # leading VAR=value assignment, or a command that isn't an executable
+            # (such as a shell builtin or keyword), still needs the shell, which also
+            # reports commands that don't exist at all, with the usual exit codes.
+            args = sys.argv[2:]
+            if args and not SHELL_ASSIGNMENT_RE.match(args[0]):
+                try:
+                    sys.exit(hermetic.run(args).returncode)
+                except (FileNotFoundError, PermissionError):
+                    pass
+            sys.exit(hermetic.run(shlex.join(args), shell=True).returncode)
         if sys.argv[1] == "true":
             sys.exit(0)
 
@@ -1,23 +1,30 @@
 from pathlib import Path
 import platform
 import os
+import re
 import tempfile
 import tarfile
 import shutil
 import subprocess
 from urllib.parse import urlparse
-from typing import Protocol
+from typing import BinaryIO, Iterator, Protocol
+import contextlib
+import io
 import json
+import hashlib
 import enum
+import functools
+import mmap
 import sys
 import textwrap
+import threading
+import concurrent.futures
 
 from packaging.version import Version
 import click
 
 import repo_root
 import hermetic
-from sha256sum import compute_sha256
 from constants import WANT, SYSROOT_NAME
 
 
@@ -32,9 +39,18 @@ class CheckDepBy(enum.Enum):
     EXACT_MATCH = 1
 
 
+@functools.cache
+def parse_version(version: str) -> Version:
+    # The strings we compare (from WANT and config.10j-HAVE.json) are fixed for
+    # the duration of a run, so there's no need to re-parse them on every check.
+    return Version(version)
+
+
 class TrackingWhatWeHave:
     def __init__(self):
         self.localdir = repo_root.localdir()
+        # Provisioning steps may run concurrently; see provision_desires().
+        self.lock = threading.Lock()
         try:
             with open(Path(self.localdir, "config.10j-HAVE.json"), "r", encoding="utf-8") as f:
                 self._have = json.load(f)
@@ -42,23 +58,26 @@ class TrackingWhatWeHave:
             self._have = {}
 
     def save(self):
-        with open(Path(self.localdir, "config.10j-HAVE.json"), "w", encoding="utf-8") as f:
+        # Write a temporary file and rename it into place, so that an interrupted
+        # save can't leave a truncated file behind (which would make us forget
+        # everything we have, and re-provision it all).
+        path = Path(self.localdir, "config.10j-HAVE.json")
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
             json.dump(self._have, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
 
     def note_we_have(self, name: str, version: Version | None = None, specifier: str | None = None):
-        match [version is None, specifier is None]:
-            case [True, True]:
-                raise ValueError(f"For '{name}' must provide either version or specifier")
-            case [False, False]:
-                raise ValueError(f"For '{name}' must provide either version or specifier, not both")
-            case _:
-                pass
+        if (version is None) == (specifier is None):
+            not_both = "" if version is None else ", not both"
+            raise ValueError(f"For '{name}' must provide either version or specifier{not_both}")
 
-        had = self._have.get(name)
-        now = str(version) if version else specifier
-        self._have[name] = now
-        if had != now:
-            self.save()
+        now = str(version) if version is not None else specifier
+        with self.lock:
+            had = self._have.get(name)
+            self._have[name] = now
+            if had != now:
+                self.save()
 
     def query(self, name: str) -> str | None:
         return self._have.get(name)
@@ -72,7 +91,7 @@ class TrackingWhatWeHave:
 
         match by:
             case CheckDepBy.VERSION:
-                if Version(self._have[name]) >= Version(wanted_spec):
+                if parse_version(self._have[name]) >= parse_version(wanted_spec):
                     return InstallationState.VERSION_OK
             case CheckDepBy.EXACT_MATCH:
                 if self._have[name] == wanted_spec:
@@ -92,16 +111,179 @@ def sez(msg: str, ctx: str, err=False):
     click.echo("TENJIN SEZ: " + ctx + msg, err=err)
 
 
+# Read size for streamed tarball extraction; tarfile's default is only 10 KiB.
+TAR_STREAM_BUFSIZE = 1024 * 1024
+# Chunk size when copying each member's data out to disk; tarfile's default is 16 KiB.
+# (The typeshed stubs for tarfile.open() don't list copybufsize, hence the type: ignores.)
+TAR_COPY_BUFSIZE = 4 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+# Set when the user interrupts provisioning. Provisioning steps running on worker
+# threads (see provision_desires()) check it between chunks of their downloads.
+PROVISIONING_CANCELLED = threading.Event()
+
+
+def check_not_cancelled() -> None:
+    if PROVISIONING_CANCELLED.is_set():
+        raise ProvisioningError("Provisioning was cancelled.")
+
+
+def preallocate_for(response, f: BinaryIO) -> None:
+    """Reserves space for f up front when the server says how big the download is."""
+    length = response.headers.get("Content-Length")
+    if not length or not hasattr(os, "posix_fallocate"):  # no posix_fallocate on macOS
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, int(length))
+    except (OSError, ValueError):
+        pass  # not every filesystem supports it, and the download works regardless
+
+
+def check_download_complete(url: str, response, received: int) -> None:
+    """
+    Raises if we got fewer bytes than the server said it would send.
+
+    Unlike urlretrieve(), reading from urlopen() treats a connection that closes
+    early as an ordinary end of file, so a truncated body would otherwise go unnoticed.
+    """
+    length = response.headers.get("Content-Length")
+    if length and length.isdigit() and received < int(length):
+        raise ProvisioningError(
+            f"Download of {url} was cut short: got {received} of {length} bytes"
+        )
+
+
+class LengthCheckedResponse(io.RawIOBase):
+    """
+    Reads through to an HTTP response, running check_download_complete() when it hits
+    the end, for when the body is consumed by something other than our own copy loops.
+    Like those loops, it stops with an error if provisioning has been cancelled.
+    """
+
+    def __init__(self, url: str, response):
+        self.url = url
+        self.response = response
+        self.received = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        check_not_cancelled()
+        n = self.response.readinto(b)
+        self.received += n
+        if n == 0 and len(b) > 0:
+            check_download_complete(self.url, self.response, self.received)
+        return n
+
+
 def download(url: str, filename: Path) -> None:
     # This import is relatively expensive (20 ms) and is rarely needed,
     # so it is imported here to avoid slowing down the common case.
-    from urllib.request import urlretrieve  # noqa: PLC0415
+    from urllib.request import urlopen  # noqa: PLC0415
+
+    # urlretrieve() copies in 8 KiB blocks; bigger reads mean far fewer syscalls.
+    try:
+        with urlopen(url) as response, open(filename, "wb") as f:
+            preallocate_for(response, f)
+            while chunk := response.read(DOWNLOAD_CHUNK_SIZE):
+                check_not_cancelled()
+                f.write(chunk)
+            check_download_complete(url, response, f.tell())
+    except BaseException:
+        # The file was preallocated to its full size, so don't leave it behind
+        # looking complete but partly filled with zeros.
+        filename.unlink(missing_ok=True)
+        raise
+
+
+def download_and_sha256(url: str, filename: Path) -> str:
+    """Like download(), but also returns the SHA-256 hex digest of the downloaded bytes.
+
+    The hash is computed as the data arrives, so the file needn't be read back afterwards.
+    """
+    # See download() for why this is imported here.
+    from urllib.request import urlopen  # noqa: PLC0415
+
+    # hashlib and file writes both release the GIL, so hashing each chunk on a
+    # helper thread overlaps it with writing that chunk and reading the next.
+    # The single worker keeps the updates in order; waiting on the previous
+    # update before queueing another bounds how many chunks are held in memory.
+    sha256_hash = hashlib.sha256()
+    try:
+        with (
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as hasher,
+            urlopen(url) as response,
+            open(filename, "wb") as f,
+        ):
+            preallocate_for(response, f)
+            pending: concurrent.futures.Future | None = None
+            while chunk := response.read(DOWNLOAD_CHUNK_SIZE):
+                check_not_cancelled()
+                if pending is not None:
+                    pending.result()
+                pending = hasher.submit(sha256_hash.update, chunk)
+                f.write(chunk)
+            if pending is not None:
+                pending.result()
+            check_download_complete(url, response, f.tell())
+    except BaseException:
+        # As in download(), don't leave a preallocated, partly written file behind.
+        filename.unlink(missing_ok=True)
+        raise
+    return sha256_hash.hexdigest()
+
+
+def make_executable(path: Path) -> None:
+    """Like `chmod +x`: adds execute permission wherever read permission is granted."""
+    mode = path.stat().st_mode
+    path.chmod(mode | ((mode & 0o444) >> 2))
+
+
+def ensure_symlink(src: Path, dst: Path) -> None:
+    """Makes dst a symbolic link to src, replacing whatever non-directory was there."""
+    try:
+        os.symlink(src, dst)
+    except FileExistsError:
+        try:
+            if os.readlink(dst) == os.fspath(src):
+                return  # the common case when re-provisioning
+        except OSError:
+            pass  # not a symlink
+
+        # Swap in the new link with a rename, so dst never goes missing.
+        tmp = dst.with_name(dst.name + ".10j-tmp")
+        tmp.unlink(missing_ok=True)
+        os.symlink(src, tmp)
+        os.replace(tmp, dst)
 
-    urlretrieve(url, filename)
 
+def remove_tree_in_background(path: Path) -> None:
+    """
+    Removes the directory tree at path, without waiting for the deletion to finish.
+
+    Deleting a big tree (an opam root, a sysroot) can take a good while, so we move
+    it aside, which is cheap on the same filesystem, and delete it on a thread while
+    we get on with other work. The thread isn't a daemon, so we won't exit before it
+    finishes. Also sweeps up trash left behind by any interrupted earlier run.
+    """
+    # A fresh, uniquely named directory to move the tree into, so that leftovers
+    # from an earlier run (even one that happened to have our PID) can't get in the way.
+    trash_dir = tempfile.mkdtemp(dir=path.parent, prefix=f"{path.name}.trash.")
+    path.rename(Path(trash_dir, path.name))
+    trash = list(path.parent.glob(f"{path.name}.trash.*"))
+
+    def take_out_trash():
+        for t in trash:
+            shutil.rmtree(t, ignore_errors=True)
+
+    threading.Thread(target=take_out_trash).start()
 
-# platform.system() in ["Linux", "Darwin"]
-# platform.machine() in ["x86_64", "arm64"]
+
+# These can't change while we run, so look them up once.
+SYSTEM = platform.system()  # in ["Linux", "Darwin"]
+MACHINE = platform.machine()  # in ["x86_64", "arm64"]
 
 
 def provision_desires(wanted: str):
@@ -126,10 +308,29 @@ def provision_desires(wanted: str):
 
     # We get these unconditionally, because both Rust and OCaml (and/or the
     # projects in those languages) end up needing them.
-    want_10j_deps()
-    want_10j_llvm()
-    want_10j_sysroot_extras()
-    want_cmake()
+    #
+    # Each is dominated by a download from a different host, and they install
+    # into separate directories, so we fetch them concurrently. The sysroot
+    # extras are copied into the LLVM tree, so they must wait for LLVM.
+    def want_10j_llvm_and_sysroot_extras():
+        want_10j_llvm()
+        want_10j_sysroot_extras()
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            futures = [
+                pool.submit(want_10j_deps),
+                pool.submit(want_10j_llvm_and_sysroot_extras),
+                pool.submit(want_cmake),
+            ]
+    except BaseException:
+        # Typically Ctrl-C, which only interrupts this thread. The workers can't
+        # be interrupted, and we can't exit until they finish, so ask them to stop.
+        PROVISIONING_CANCELLED.set()
+        raise
+    # Re-raise the first failure, if any, only after all the others have finished.
+    for future in futures:
+        future.result()
 
     if wanted in ("all", "ocaml"):
         want_dune()
@@ -154,7 +355,7 @@ def require_rust_stuff():
     # run via 10j.
     def complain_about_tool_then_die(tool: str):
         say(f"{tool} is not installed, or is not available on your $PATH")
-        match platform.system():
+        match SYSTEM:
             case "Linux":
                 say("Please install Rust using rustup (or via your package manager).")
             case "Darwin":
@@ -164,7 +365,7 @@ def require_rust_stuff():
                 sys.exit(1)
 
         download("https://sh.rustup.rs", Path("rustup-installer.sh"))
-        subprocess.check_call(["chmod", "+x", "rustup-installer.sh"])
+        make_executable(Path("rustup-installer.sh"))
 
         say("")
         say("For your convenience, I've downloaded the rustup installer script,")
@@ -197,34 +398,45 @@ def want_generic(
     titlename: str,
     by: CheckDepBy,
     provisioner: Provisioner,
-):
+) -> bool:
+    """Returns True if the provisioner was run, False if what we have is fine."""
+    wanted = WANT[keyname]
     match HAVE.compatible(keyname, by):
         case InstallationState.VERSION_OK:
-            return
+            return False
         case InstallationState.VERSION_TOO_OLD:
             sez(f"{titlename} version is outdated; re-provisioning...", ctx=f"({lowername}) ")
-            provisioner(HAVE.localdir, version=WANT[keyname])
+            provisioner(HAVE.localdir, version=wanted)
         case InstallationState.NOT_INSTALLED:
-            provisioner(HAVE.localdir, version=WANT[keyname])
+            provisioner(HAVE.localdir, version=wanted)
+    return True
+
+
+def want_version_generic(
+    keyname: str, lowername: str, titlename: str, provisioner: Provisioner
+) -> bool:
+    return want_generic(keyname, lowername, titlename, CheckDepBy.VERSION, provisioner)
 
 
-def want_version_generic(keyname: str, lowername: str, titlename: str, provisioner: Provisioner):
-    want_generic(keyname, lowername, titlename, CheckDepBy.VERSION, provisioner)
+CMAKE_VERSION_RE = re.compile(r"\s*cmake\s+version\s+(\S+)\s*")
 
 
 def want_cmake() -> None:
-    want_version_generic("10j-cmake", "cmake", "CMake", provision_cmake_into)
-    out: bytes = hermetic.run_shell_cmd("cmake --version", check=True, capture_output=True).stdout
+    # Only ask the freshly provisioned binary for its version; otherwise,
+    # HAVE already recorded it and there's no need to spawn a process.
+    if not want_version_generic("10j-cmake", "cmake", "CMake", provision_cmake_into):
+        return
+
+    out: bytes = hermetic.run(["cmake", "--version"], check=True, capture_output=True).stdout
     outstr = out.decode("utf-8")
     lines = outstr.splitlines()
     if lines == []:
         raise ProvisioningError("CMake version command returned no output.")
-    else:
-        match lines[0].split():
-            case ["cmake", "version", version]:
-                HAVE.note_we_have("10j-cmake", version=Version(version))
-            case _:
-                raise ProvisioningError(f"Unexpected output from CMake version command:\n{outstr}")
+
+    m = CMAKE_VERSION_RE.fullmatch(lines[0])
+    if m is None:
+        raise ProvisioningError(f"Unexpected output from CMake version command:\n{outstr}")
+    HAVE.note_we_have("10j-cmake", version=Version(m.group(1)))
 
 
 def want_dune():
@@ -240,7 +452,10 @@ def want_ocaml():
 
 
 def want_10j_llvm():
-    want_version_generic("10j-llvm", "llvm", "LLVM", provision_10j_llvm_into)
+    # As with want_cmake(), we only need llvm-config's answer after provisioning.
+    if not want_version_generic("10j-llvm", "llvm", "LLVM", provision_10j_llvm_into):
+        return
+
     out = subprocess.check_output([
         hermetic.xj_llvm_root(HAVE.localdir) / "bin" / "llvm-config",
         "--version",
@@ -249,41 +464,46 @@ def want_10j_llvm():
 
 
 def want_10j_sysroot_extras():
-    if platform.system() != "Linux":
+    if SYSTEM != "Linux":
         return
 
     key = "10j-bullseye-sysroot-extras"
 
     def provision_10j_sysroot_extras_into(localdir: Path, version: str):
-        filename = f"xj-bullseye-sysroot-extras_{platform.machine()}.tar.xz"
+        llvm_root = hermetic.xj_llvm_root(localdir)
+        filename = f"xj-bullseye-sysroot-extras_{MACHINE}.tar.xz"
         url = (
             f"https://github.com/brkaarno/xj-build-deps-test/releases/download/{version}/{filename}"
         )
 
-        tarball = hermetic.xj_llvm_root(localdir) / filename
-        download(url, tarball)
-
-        tmp_dest = hermetic.xj_llvm_root(localdir) / "tmp"
-        tmp_dest.mkdir()
-
-        shutil.unpack_archive(tarball, tmp_dest, filter="tar")
-        tarball.unlink()
-
-        triple = f"{platform.machine()}-linux-gnu"
-        shutil.copytree(
-            tmp_dest / "debian-bullseye_gcc_glibc" / platform.machine() / "usr_lib",
-            hermetic.xj_llvm_root(localdir) / "sysroot" / "usr" / "lib" / triple,
-            dirs_exist_ok=True,
-        )
-
-        # We need the .a files to enable static linking for our hermetic clang.
-        shutil.copytree(
-            tmp_dest / "debian-bullseye_gcc_glibc" / platform.machine() / "usr_lib_gcc",
-            hermetic.xj_llvm_root(localdir) / "sysroot" / "usr" / "lib" / "gcc" / triple / "10",
-            dirs_exist_ok=True,
-        )
+        # Extract straight from the response, without saving the tarball first.
+        from urllib.request import urlopen  # noqa: PLC0415
+
+        # The scratch directory goes away however we leave, so a failed
+        # download doesn't leave anything behind to trip up the next attempt.
+        with tempfile.TemporaryDirectory(dir=llvm_root) as tmp:
+            tmp_dest = Path(tmp)
+            with (
+                urlopen(url) as response,
+                open_tar_stream(
+                    io.BufferedReader(LengthCheckedResponse(url, response)), filename
+                ) as tar,
+            ):
+                tar.extractall(tmp_dest, numeric_owner=True, filter="tar")
+
+            triple = f"{MACHINE}-linux-gnu"
+            shutil.copytree(
+                tmp_dest / "debian-bullseye_gcc_glibc" / MACHINE / "usr_lib",
+                llvm_root / "sysroot" / "usr" / "lib" / triple,
+                dirs_exist_ok=True,
+            )
 
-        shutil.rmtree(tmp_dest)
+            # We need the .a files to enable static linking for our hermetic clang.
+            shutil.copytree(
+                tmp_dest / "debian-bullseye_gcc_glibc" / MACHINE / "usr_lib_gcc",
+                llvm_root / "sysroot" / "usr" / "lib" / "gcc" / triple / "10",
+                dirs_exist_ok=True,
+            )
 
         HAVE.note_we_have(key, specifier=version)
 
@@ -291,7 +511,7 @@ def want_10j_sysroot_extras():
 
 
 def want_10j_deps():
-    if platform.system() == "Darwin":
+    if SYSTEM == "Darwin":
         return
 
     key = "10j-build-deps"
@@ -345,7 +565,7 @@ def provision_ocaml(ocaml_version: str):
             # try to reuse what's already there.
             opamroot = localdir / "opamroot"
             if opamroot.is_dir():
-                shutil.rmtree(opamroot)
+                remove_tree_in_background(opamroot)
 
         sandboxing_arg = infer_bwrap_sandboxing_args(localdir)
 
@@ -383,13 +603,14 @@ def provision_ocaml(ocaml_version: str):
         say("      (subsequent output comes from `opam switch create`)")
         say("----------------------------------------------------------------")
 
+        llvm_bindir = hermetic.xj_llvm_root(localdir) / "bin"
         hermetic.check_call_opam(
             ["switch", "create", TENJIN_SWITCH, ocaml_version, "--no-switch"],
             eval_opam_env=False,
             env_ext={
                 "OPAMNOENVNOTICE": "1",
-                "CC": str(hermetic.xj_llvm_root(localdir) / "bin" / "clang"),
-                "CXX": str(hermetic.xj_llvm_root(localdir) / "bin" / "clang++"),
+                "CC": str(llvm_bindir / "clang"),
+                "CXX": str(llvm_bindir / "clang++"),
             },
         )
 
@@ -400,8 +621,6 @@ def provision_debian_bullseye_sysroot_into(target_arch: str, dest_sysroot: Path)
     def say(msg: str):
         sez(msg, ctx="(sysroot) ")
 
-    say("Downloading and unpacking sysroot tarball, will take maybe 10 s...")
-
     CHROME_LINUX_SYSROOT_URL = "https://commondatastorage.googleapis.com/chrome-linux-sysroot"
 
     # These don't go in WANT because they're quite stable;
@@ -415,17 +634,32 @@ def provision_debian_bullseye_sysroot_into(target_arch: str, dest_sysroot: Path)
 
     url = CHROME_LINUX_SYSROOT_URL + "/" + tarball_sha256sum
 
+    # The sysroot is fetched as part of provisioning LLVM, which has its own
+    # version, so record which sysroot we unpacked to avoid redoing it needlessly.
+    stamp = dest_sysroot / "tenjin-sysroot.sha256"
+    try:
+        if stamp.read_text(encoding="utf-8") == tarball_sha256sum:
+            say("Reusing previously unpacked sysroot.")
+            return
+    except OSError:
+        pass
+
+    say("Downloading and unpacking sysroot tarball, will take maybe 10 s...")
+
     if dest_sysroot.is_dir():
-        shutil.rmtree(dest_sysroot)
+        remove_tree_in_background(dest_sysroot)
     dest_sysroot.mkdir()
     tarball = dest_sysroot / "tenjin-sysroot.tar.xz"
 
-    download(url, tarball)
-    sha256sum = compute_sha256(tarball)
+    sha256sum = download_and_sha256(url, tarball)
     if sha256sum != tarball_sha256sum:
+        # Don't leave a corrupt tarball lying around.
+        tarball.unlink()
         raise ProvisioningError("Sysroot hash verification failed!")
-    shutil.unpack_archive(tarball, dest_sysroot, filter="tar")
+    with open(tarball, "rb") as f, open_tar_stream(f, tarball.name) as tar:
+        tar.extractall(dest_sysroot, numeric_owner=True, filter="tar")
     tarball.unlink()
+    stamp.write_text(tarball_sha256sum, encoding="utf-8")
 
 
 def provision_opam_binary_into(opam_version: str, localdir: Path) -> None:
@@ -436,7 +670,7 @@ def provision_opam_binary_into(opam_version: str, localdir: Path) -> None:
     sys_opam = shutil.which("opam")
     if sys_opam is not None:
         sys_opam_version = subprocess.check_output([sys_opam, "--version"]).decode("utf-8")
-        if Version(sys_opam_version) >= Version(opam_version):
+        if Version(sys_opam_version) >= parse_version(opam_version):
             say(f"Symlinking to a suitable version of opam at {sys_opam}")
             os.symlink(sys_opam, str(localdir / "opam"))
             return
@@ -449,10 +683,16 @@ def provision_opam_binary_into(opam_version: str, localdir: Path) -> None:
     if not installer_sh.is_file():
         raise ProvisioningError(f"Unable to download installer script for opam {opam_version}.")
     subprocess.check_call(["sh", installer_sh, "--download-only", "--version", opam_version])
-    tagged = list(Path(".").glob(f"opam-{opam_version}-*"))
-    assert len(tagged) == 1
-    tagged_path = tagged[0]
-    subprocess.check_call(["chmod", "+x", tagged_path])
+    # The installer names the binary opam-VERSION-ARCH-OS; look for that directly,
+    # falling back to a glob in case its naming doesn't match our guess.
+    opam_arch = {"aarch64": "arm64", "amd64": "x86_64"}.get(MACHINE, MACHINE)
+    opam_os = {"Darwin": "macos"}.get(SYSTEM, SYSTEM.lower())
+    tagged_path = Path(f"opam-{opam_version}-{opam_arch}-{opam_os}")
+    if not tagged_path.is_file():
+        tagged = list(Path(".").glob(f"opam-{opam_version}-*"))
+        assert len(tagged) == 1
+        tagged_path = tagged[0]
+    make_executable(tagged_path)
     tagged_path.replace(localdir / "opam")
 
     if hermetic.running_in_ci():
@@ -476,8 +716,19 @@ def provision_dune_into(_localdir: Path, version: str):
     HAVE.note_we_have("10j-dune", version=Version(grab_dune_version_str()))
 
 
+def probably_in_container() -> bool:
+    """Cheap checks for Docker and similar; a False result is not conclusive."""
+    if Path("/.dockerenv").exists() or Path("/run/.containerenv").exists():
+        return True
+    try:
+        cgroup = Path("/proc/1/cgroup").read_text(encoding="utf-8", errors="replace")
+    except OSError:
+        return False
+    return any(word in cgroup for word in ("docker", "containerd", "kubepods", "libpod"))
+
+
 def infer_bwrap_sandboxing_args(localdir: Path) -> list[str]:
-    if platform.system() != "Linux":
+    if SYSTEM != "Linux":
         return []  # bwrap is Linux-only
 
     bwrap_path = hermetic.xj_build_deps(localdir) / "bin" / "bwrap"
@@ -486,8 +737,12 @@ def infer_bwrap_sandboxing_args(localdir: Path) -> list[str]:
 
     # Bubblewrap does not work inside Docker containers, at least not without
     # heinous workarounds, if we're in Docker then we don't really need it anyway.
-    # So we'll try running a trivial command with it; if it fails, we'll tell opam
-    # not to use it.
+    # When it's obvious that we're in a container, skip straight to the answer.
+    if probably_in_container():
+        return ["--disable-sandboxing"]
+
+    # Otherwise we'll try running a trivial command with it; if it fails, we'll
+    # tell opam not to use it.
     #
     # We really want to run a statically linked binary, since
     # for a dynamically linked binary we'd need to add symlinks
@@ -505,7 +760,7 @@ def infer_bwrap_sandboxing_args(localdir: Path) -> list[str]:
 
     try:
         compile_cmd = ["clang", temp_c_file_path, "-static", "-o", str(binary_path)]
-        hermetic.run_shell_cmd(compile_cmd, check=True)
+        hermetic.run(compile_cmd, check=True)
         os.chmod(binary_path, 0o755)
 
         subprocess.check_call([bwrap_path, "--ro-bind", Path.cwd(), "/", "/tru"])
@@ -566,7 +821,7 @@ def provision_cmake_into(localdir: Path, version: str):
         return f"https://github.com/Kitware/CMake/releases/download/v{version}/cmake-{version}-{tag}.tar.gz"
 
     def mk_url() -> str:
-        match [platform.system(), platform.machine()]:
+        match [SYSTEM, MACHINE]:
             case ["Linux", "x86_64"]:
                 return fmt_url("linux-x86_64")
             case ["Linux", "arm64"]:
@@ -581,7 +836,7 @@ def provision_cmake_into(localdir: Path, version: str):
     cmake_dir = localdir / "cmake"
     download_and_extract_tarball(mk_url(), cmake_dir, ctx="(cmake) ", time_estimate=None)
 
-    if platform.system() == "Darwin" and (cmake_dir / "CMake.app").is_dir():
+    if SYSTEM == "Darwin" and (cmake_dir / "CMake.app").is_dir():
         # The tarball for macOS contains a .app bundle; we'll make a symlink
         # into it to create paths consistent with other platforms.
         cmake_app_bin = cmake_dir / "CMake.app" / "Contents" / "bin"
@@ -589,8 +844,11 @@ def provision_cmake_into(localdir: Path, version: str):
 
 
 def provision_10j_llvm_into(localdir: Path, version: str):
+    llvm_root = hermetic.xj_llvm_root(localdir)
+    llvm_bindir = llvm_root / "bin"
+
     def provision_clang_config_files(sysroot_path):
-        match platform.system():
+        match SYSTEM:
             case "Linux":
                 platform_specific_stuff = textwrap.dedent("""\
                     # This one's unfortunate. LLD defaults to --no-allow-shlib-undefined
@@ -604,21 +862,15 @@ def provision_10j_llvm_into(localdir: Path, version: str):
                 platform_specific_stuff = ""
 
         # Write config files to make sure that the sysroot is used by default.
+        config = textwrap.dedent(f"""\
+            --sysroot {sysroot_path}
+            {platform_specific_stuff}
+            """)
         for name in ("clang", "clang++", "cc", "c++"):
-            with open(
-                hermetic.xj_llvm_root(localdir) / "bin" / f"{name}.cfg", "w", encoding="utf-8"
-            ) as f:
-                f.write(
-                    textwrap.dedent(f"""\
-                        --sysroot {sysroot_path}
-                        {platform_specific_stuff}
-                        """)
-                )
+            (llvm_bindir / f"{name}.cfg").write_text(config, encoding="utf-8")
 
     def provision_debian_sysroot():
-        provision_debian_bullseye_sysroot_into(
-            platform.machine(), hermetic.xj_llvm_root(localdir) / SYSROOT_NAME
-        )
+        provision_debian_bullseye_sysroot_into(MACHINE, llvm_root / SYSROOT_NAME)
 
         #                   COMMENTARY(goblint-cil-gcc-wrapper)
         # Okay, this one is unfortunate. We generally only care about software that
@@ -628,7 +880,7 @@ def provision_10j_llvm_into(localdir: Path, version: str):
         # do here is write out a wrapper script for goblint-cil to find, which will
         # intercept the GCC-specific stuff in the code it compiles and patch it out
         # before passing it on to Clang. Hurk!
-        sadness = hermetic.xj_llvm_root(localdir) / "goblint-sadness"
+        sadness = llvm_root / "goblint-sadness"
         sadness.mkdir(exist_ok=True)
         gcc_wrapper_path = sadness / "gcc"
         with open(gcc_wrapper_path, "w", encoding="utf-8") as f:
@@ -664,41 +916,32 @@ def provision_10j_llvm_into(localdir: Path, version: str):
         # Add symbolic links for the binutils-alike tools.
         # Tools not provided by LLVM: ranlib, size
         binutils_names = ["ar", "as", "nm", "objcopy", "objdump", "readelf", "strings", "strip"]
-        for name in binutils_names:
-            src = hermetic.xj_llvm_root(localdir) / "bin" / f"llvm-{name}"
-            dst = hermetic.xj_llvm_root(localdir) / "bin" / f"{name}"
-            if not dst.is_symlink():
-                os.symlink(src, dst)
+        symlinks = [(f"llvm-{name}", name) for name in binutils_names]
 
         # These symbolic links follow a different naming pattern.
-        symlinks = [("clang", "cc"), ("clang++", "c++")]
-        if platform.system() != "Darwin":
+        symlinks += [("clang", "cc"), ("clang++", "c++")]
+        if SYSTEM != "Darwin":
             # On macOS, lld does not support -r (--relocatable) but the flag is used
             # by OCaml's build system, so we omit the symlink. This means that Clang
             # will use ld64.lld directly, but when OCaml invokes ld, it will get the
             # system's ld64 (non-LLD).
             symlinks.append(("lld", "ld"))
         for src, dst in symlinks:
-            src = hermetic.xj_llvm_root(localdir) / "bin" / src
-            dst = hermetic.xj_llvm_root(localdir) / "bin" / dst
-            if not dst.is_symlink():
-                os.symlink(src, dst)
+            ensure_symlink(llvm_bindir / src, llvm_bindir / dst)
 
-    tarball_name = f"LLVM-{version}-{platform.system()}-{platform.machine()}.tar.xz"
+    tarball_name = f"LLVM-{version}-{SYSTEM}-{MACHINE}.tar.xz"
     if Path(tarball_name).is_file():
         extract_tarball(
             Path(tarball_name),
-            hermetic.xj_llvm_root(localdir),
+            llvm_root,
             ctx="(llvm) ",
             time_estimate="twenty seconds or so",
         )
     else:
         url = f"https://images.aarno-labs.com/amp/ben/{tarball_name}"
-        download_and_extract_tarball(
-            url, hermetic.xj_llvm_root(localdir), ctx="(llvm) ", time_estimate="a minute"
-        )
+        download_and_extract_tarball(url, llvm_root, ctx="(llvm) ", time_estimate="a minute")
 
-    match platform.system():
+    match SYSTEM:
         case "Linux":
             provision_debian_sysroot()
             provision_clang_config_files(sysroot_path=f"<CFGDIR>/../{SYSROOT_NAME}")
@@ -736,16 +979,18 @@ def cook_pkg_config_within(localdir: Path):
     pcpath = path_of_unusual_size + b"/lib/pkgconfig:" + path_of_unusual_size + b"/share/pkgconfig"
     nullbyte = b"\0"
 
-    bindir = hermetic.xj_build_deps(localdir) / "bin"
+    build_deps = hermetic.xj_build_deps(localdir)
+    bindir = build_deps / "bin"
+    sysroot_usr = hermetic.xj_llvm_root(localdir) / "sysroot" / "usr"
 
     uncooked = bindir / "pkg-config.uncooked"
     assert uncooked.is_file()
     cooked = bindir / "pkg-config"
     shutil.copy(uncooked, cooked)
 
-    def replace_null_terminated_needle_in(haystack: bytes, needle: bytes, newstuff: bytes) -> bytes:
+    def replace_null_terminated_needle_in(haystack: mmap.mmap, needle: bytes, newstuff: bytes):
         # Make sure is has the embedded path/data we are expecting it to have.
-        assert (needle + nullbyte) in haystack
+        assert haystack.find(needle + nullbyte) != -1
 
         assert len(newstuff) <= len(needle)
         if len(newstuff) < len(needle):
@@ -753,50 +998,46 @@ def cook_pkg_config_within(localdir: Path):
             newstuff += b"\0" * (len(needle) - len(newstuff))
 
         assert len(newstuff) == len(needle)
-        return haystack.replace(needle, newstuff)
+        # Like bytes.replace(), overwrite every occurrence, not just the first.
+        off = haystack.find(needle)
+        while off != -1:
+            haystack[off : off + len(needle)] = newstuff
+            off = haystack.find(needle, off + len(needle))
 
     say("Cooking pkg-config...")
-    with open(cooked, "r+b") as f:
-        # Read the file into memory
-        data = f.read()
-
-        sysroot_usr = hermetic.xj_llvm_root(localdir) / "sysroot" / "usr"
+    # Patch the binary in place through a mapping, rather than making a fresh
+    # copy of the whole file for each of the four replacements.
+    with open(cooked, "r+b") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE) as mm:
         newpcpath_lib = sysroot_usr / "lib" / "pkgconfig"
         newpcpath_shr = sysroot_usr / "share" / "pkgconfig"
 
         # Replace the placeholder strings with the actual paths.
         # Note that we set up the paths to include pkg-config's standard paths as backups,
         # in case the user is trying to compile against a library that isn't in the sysroot.
-        data = replace_null_terminated_needle_in(
-            data,
+        replace_null_terminated_needle_in(
+            mm,
             sysinc,
             bytes(sysroot_usr / "include") + b":/usr/include",
         )
-        data = replace_null_terminated_needle_in(
-            data,
+        replace_null_terminated_needle_in(
+            mm,
             syslib,
             bytes(sysroot_usr / "lib") + b":/usr/lib:/lib",
         )
-        data = replace_null_terminated_needle_in(
-            data, pcpath, bytes(newpcpath_lib) + b":" + bytes(newpcpath_shr) + b":/usr/lib:/lib"
-        )
-        data = replace_null_terminated_needle_in(
-            data, libdir, bytes(hermetic.xj_build_deps(localdir) / "lib")
+        replace_null_terminated_needle_in(
+            mm, pcpath, bytes(newpcpath_lib) + b":" + bytes(newpcpath_shr) + b":/usr/lib:/lib"
         )
+        replace_null_terminated_needle_in(mm, libdir, bytes(build_deps / "lib"))
 
-        # Write the modified data back to the file
-        f.seek(0)
-        f.write(data)
-        f.truncate()
+        assert mm.find(path_of_unusual_size) == -1, "Oops, pkg-config was left undercooked!"
+        mm.flush()
     say("... done cooking pkg-config.")
 
-    assert path_of_unusual_size not in data, "Oops, pkg-config was left undercooked!"
-
 
 def provision_10j_deps_into(localdir: Path, version: str):
-    match platform.system():
+    match SYSTEM:
         case "Linux":
-            filename = f"xj-build-deps_{platform.machine()}.tar.xz"
+            filename = f"xj-build-deps_{MACHINE}.tar.xz"
             url = f"https://github.com/brkaarno/xj-build-deps-test/releases/download/{version}/{filename}"
             download_and_extract_tarball(
                 url,
@@ -834,10 +1075,15 @@ def download_and_extract_tarball(
     """
     Downloads a compressed tar file from the given URL and extracts it to the target directory.
 
+    The tarball is extracted as it arrives, rather than being saved to disk first,
+    so decompression overlaps with the download and the tarball is never written out.
+
     Args:
         tarball_url (str): URL of the tarball file to download
         target_dir (str): Directory to extract contents to.
     """
+    # See download() for why this is imported here.
+    from urllib.request import urlopen  # noqa: PLC0415
 
     def say(msg: str):
         sez(msg, ctx)
@@ -845,39 +1091,187 @@ def download_and_extract_tarball(
     if time_estimate:
         say(f"This will take {time_estimate}...")
 
-    try:
-        # Create a temporary file name for the download
-        temp_file = os.path.basename(urlparse(tarball_url).path)
-
-        say(f"Downloading {tarball_url}...")
-        download(tarball_url, Path(temp_file))
-    except Exception:
-        # Clean up any temporary files if they exist
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
-        raise
+    tarball_name = os.path.basename(urlparse(tarball_url).path)
 
-    extract_tarball(Path(temp_file), target_dir, ctx, None)
+    say(f"Downloading {tarball_url}...")
+    # Extract into a scratch directory next to the target, and only move the result
+    # into place once the whole tarball has arrived intact. That way a failed download
+    # never leaves a half-filled target behind for the next attempt to trip over.
+    target_dir.parent.mkdir(parents=True, exist_ok=True)
+    staging = Path(tempfile.mkdtemp(dir=target_dir.parent, prefix=f"{target_dir.name}.partial."))
+    try:
+        with urlopen(tarball_url) as response:
+            body = io.BufferedReader(LengthCheckedResponse(tarball_url, response))
+            extract_tarball_fileobj(body, tarball_name, staging, ctx, None)
+            # tarfile stops at the end-of-archive marker; read the rest so that
+            # a body cut short is still noticed.
+            while body.read(TAR_STREAM_BUFSIZE):
+                pass
 
-    # Clean up the temporary file
-    os.remove(temp_file)
+        # As in extract_tarball_fileobj(), a non-empty target gets a subdirectory.
+        if is_empty_dir(target_dir) or not target_dir.exists():
+            final_target_dir = target_dir
+        else:
+            final_target_dir = target_dir / tarball_basename_of(tarball_name)
+            if final_target_dir.exists():
+                remove_tree_in_background(final_target_dir)
+        os.replace(staging, final_target_dir)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
 
-    say(f"Download and extraction of {temp_file} completed successfully!")
+    say(f"Download and extraction of {tarball_name} completed successfully!")
 
 
 # The extraction process is about twice as slow on macOS
 # for clang+llvm versus the native bsdtar utility, but
 # since this is a one-time cost it seems better to just
 # avoid non-Python dependencies as much as we can.
+# (The one exception is xz, which open_tar_stream() uses when it's around,
+# because decompression is the bulk of the cost; tarfile still does the
+# unpacking, so that members_without_leading_dir() and the "tar" filter
+# behave the same everywhere, regardless of which tar is installed.)
 def extract_tarball(
     tarball_path: Path, initial_target_dir: Path, ctx: str, time_estimate="a few seconds"
 ) -> Path:
     """
     Extracts the given tarball into (or within) the target directory.
 
+    See extract_tarball_fileobj() for details.
+    """
+    with open(tarball_path, "rb") as f:
+        return extract_tarball_fileobj(f, tarball_path.name, initial_target_dir, ctx, time_estimate)
+
+
+@contextlib.contextmanager
+def open_tar_stream(fileobj: BinaryIO, tarball_name: str) -> Iterator[tarfile.TarFile]:
+    """
+    Opens a (compressed) tarball for reading sequentially from fileobj.
+
+    Stream mode ("r|") only reads forward, so this works on a network response
+    as well as on a local file.
+
+    Decompressing xz is the slowest part of extracting our big tarballs, and Python's
+    lzma module does it on the same thread that writes out the files. So when the
+    xz tool is available, we pipe the tarball through it instead: decompression then
+    overlaps with extraction, and xz can use multiple threads for multi-block archives.
+    """
+    xz = shutil.which("xz") if tarball_name.endswith(".tar.xz") else None
+    if xz is None:
+        with tarfile.open(  # type: ignore[call-overload]
+            fileobj=fileobj, mode="r|*", bufsize=TAR_STREAM_BUFSIZE, copybufsize=TAR_COPY_BUFSIZE
+        ) as tar:
+            yield tar
+        return
+
+    proc = subprocess.Popen(
+        [xz, "--decompress", "--stdout", "--threads=0"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    assert proc.stdin is not None and proc.stdout is not None
+    xz_stdin, xz_stdout = proc.stdin, proc.stdout
+
+    feed_errors: list[BaseException] = []
+
+    def feed_xz():
+        try:
+            shutil.copyfileobj(fileobj, xz_stdin, DOWNLOAD_CHUNK_SIZE)
+        except BrokenPipeError:
+            pass  # xz exited early; its exit status tells us why
+        except BaseException as e:
+            feed_errors.append(e)
+        finally:
+            try:
+                xz_stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=feed_xz, daemon=True)
+    feeder.start()
+    try:
+        with tarfile.open(  # type: ignore[call-overload]
+            fileobj=xz_stdout, mode="r|", bufsize=TAR_STREAM_BUFSIZE, copybufsize=TAR_COPY_BUFSIZE
+        ) as tar:
+            yield tar
+        # tarfile stops at the end-of-archive marker, which may precede some padding.
+        while xz_stdout.read(TAR_STREAM_BUFSIZE):
+            pass
+    except BaseException as e:
+        proc.kill()
+        feeder.join()
+        # If reading the input failed (say, a download cut short), that's the real
+        # problem; tarfile merely ran out of data as a consequence.
+        if feed_errors and not isinstance(e, KeyboardInterrupt):
+            raise feed_errors[0] from e
+        raise
+    finally:
+        xz_stdout.close()
+        feeder.join()
+        proc.wait()
+
+    if feed_errors:
+        raise feed_errors[0]
+    if proc.returncode != 0:
+        raise ProvisioningError(f"xz failed to decompress {tarball_name} (exit {proc.returncode})")
+
+
+def members_without_leading_dir(tar: tarfile.TarFile, dirname: str) -> Iterator[tarfile.TarInfo]:
+    """
+    Yields the members of tar, minus the leading dirname/ in their paths, if the
+    archive starts with that directory. Otherwise, yields the members unchanged.
+
+    Works in stream mode, since it only looks at each member as it's reached.
+    """
+    prefix = dirname + "/"
+    stripping: bool | None = None
+    for member in tar:
+        name = member.name.removeprefix("./")
+        if stripping is None:
+            stripping = name == dirname or name.startswith(prefix)
+
+        if stripping:
+            if name == dirname:
+                continue  # this is the directory we're extracting into
+            if name.startswith(prefix):
+                member.name = name.removeprefix(prefix)
+                if member.islnk():
+                    # Hard links name their target by its path within the archive.
+                    member.linkname = member.linkname.removeprefix("./").removeprefix(prefix)
+        yield member
+
+
+def is_empty_dir(path: Path) -> bool:
+    if not path.is_dir():
+        return False
+
+    # Unlike Path.iterdir(), which lists the whole directory up front,
+    # this stops reading after the first entry.
+    with os.scandir(path) as entries:
+        return next(entries, None) is None
+
+
+def tarball_basename_of(filename: str) -> str:
+    """The tarball's name without its suffix, e.g. foo-1.0 for foo-1.0.tar.xz."""
+    for suffix in (".tar.xz", ".tar.gz", ".tgz", ".tar.bz2"):
+        if filename.endswith(suffix):
+            return filename.removesuffix(suffix)
+    raise ValueError(f"Unknown tarball suffix for URL: {filename}")
+
+
+def extract_tarball_fileobj(
+    fileobj: BinaryIO,
+    tarball_name: str,
+    initial_target_dir: Path,
+    ctx: str,
+    time_estimate="a few seconds",
+) -> Path:
+    """
+    Extracts a tarball, read sequentially from fileobj, into (or within) the target directory.
+
     If the tarball unpacks a single directory with the same name as the tarball
-    (minus the suffix), the contents of that directory will be moved up a level,
-    and the empty directory will be removed.
+    (minus the suffix), the contents of that directory are extracted a level up,
+    without the directory itself.
 
     Returns the path to the directory that contains the unpacked contents.
     """
@@ -885,31 +1279,9 @@ def extract_tarball(
     def say(msg: str):
         sez(msg, ctx)
 
-    def is_empty_dir(path: Path) -> bool:
-        if not path.is_dir():
-            return False
-
-        is_empty = True
-        for item in path.iterdir():
-            is_empty = False
-            break
-        return is_empty
-
     def choose_target_dir(initial_target_dir: Path) -> tuple[Path, str]:
         # Check if the tarball unpacks a single directory with the same name as the tarball
-        def select_tarball_suffix(filename: str) -> str:
-            if filename.endswith(".tar.xz"):
-                return ".tar.xz"
-            elif filename.endswith(".tar.gz"):
-                return ".tar.gz"
-            elif filename.endswith(".tgz"):
-                return ".tgz"
-            elif filename.endswith(".tar.bz2"):
-                return ".tar.bz2"
-            raise ValueError(f"Unknown tarball suffix for URL: {filename}")
-
-        suffix = select_tarball_suffix(tarball_path.name)
-        tarball_basename = tarball_path.name.removesuffix(suffix)
+        tarball_basename = tarball_basename_of(tarball_name)
 
         target_dir_preexisted = initial_target_dir.is_dir()
         if target_dir_preexisted and not is_empty_dir(initial_target_dir):
@@ -936,23 +1308,23 @@ def extract_tarball(
     # Create target/parent directory if it doesn't exist
     initial_target_dir.mkdir(parents=True, exist_ok=True)
 
-    # Extract the compressed tar file
-    with tarfile.open(str(tarball_path), "r:*") as tar:
-        tar.extractall(path=final_target_dir)
-
-    if time_estimate is not None:
-        say(f"Extraction of {tarball_path.name} completed successfully!")
-
     # For example, we have foo-bar.tar.gz, and unpack it into blah/;
-    #   then if we find blah/foo-bar/, we trim out the foo-bar part.
-
-    if list(final_target_dir.iterdir()) == [final_target_dir / tarball_basename]:
-        extracted_path = final_target_dir / tarball_basename
-        # If the tarball unpacks a single directory, move its contents up a level
-        for item in extracted_path.iterdir():
-            shutil.move(str(item), str(final_target_dir))
+    #   then rather than producing blah/foo-bar/..., we trim out the foo-bar part.
+    # Doing this as we extract saves renaming every file afterwards.
+    #
+    # The "tar" filter keeps tar's own semantics (and so avoids the stricter, slower
+    # checks of the "data" filter, the default from Python 3.14), while still refusing
+    # absolute paths and paths outside the target. numeric_owner avoids looking up
+    # user and group names for each entry when running as root.
+    with open_tar_stream(fileobj, tarball_name) as tar:
+        tar.extractall(
+            path=final_target_dir,
+            members=members_without_leading_dir(tar, tarball_basename),
+            numeric_owner=True,
+            filter="tar",
+        )
 
-        # Remove the now-empty directory
-        extracted_path.rmdir()
+    if time_estimate is not None:
+        say(f"Extraction of {tarball_name} completed successfully!")
 
     return final_target_dir
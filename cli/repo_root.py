@@ -1,12 +1,16 @@
 from pathlib import Path
+import functools
 import os
 from sys import argv
 
 
+@functools.cache
 def localdir() -> Path:
     return find_repo_root_dir_Path() / "_local"
 
 
+# The CLI never changes its working directory, so the walk's result is fixed per process.
+@functools.cache
 def find_repo_root_dir_Path(start_dir=None) -> Path:
     def validate_candidate_dir(p: Path):
         return (p / "cli" / "sh" / "provision.sh").is_file()
@@ -11,14 +11,10 @@ def compute_sha256(file_path) -> str | None:
     Returns:
         str: The SHA256 hash as a hexadecimal string
     """
-    sha256_hash = hashlib.sha256()
-
     try:
         with open(file_path, "rb") as f:
-            # Read the file in chunks to handle large files efficiently
-            for byte_block in iter(lambda: f.read(8192), b""):
-                sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
+            # file_digest() reads in large chunks without a Python-level loop per chunk.
+            return hashlib.file_digest(f, "sha256").hexdigest()
     except Exception as e:
         print(f"Error computing hash: {e}")
         return None